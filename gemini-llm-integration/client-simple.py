@@ -1,8 +1,11 @@
 import asyncio
+import hashlib
 import json
 import os
+import sqlite3
+import time
 from datetime import datetime
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Tuple
 
 from google import genai
 from google.genai import types
@@ -21,22 +24,171 @@ if not GEMINI_API_KEY:
 # Initialize Gemini client
 client = genai.Client(api_key=GEMINI_API_KEY)
 
+# Answer cache settings (set ANSWER_CACHE_PATH to an empty string to disable)
+ANSWER_CACHE_PATH = os.getenv(
+    'ANSWER_CACHE_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".answer_cache.sqlite3")
+)
+ANSWER_CACHE_TTL_SECONDS = float(os.getenv('ANSWER_CACHE_TTL_SECONDS', '3600'))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv('ANSWER_CACHE_MAX_ENTRIES', '1000'))
+
+
+class AnswerCache:
+    """SQLite-backed cache of final answers with TTL and least-recently-used eviction.
+    
+    Database errors during lookups and writes (e.g. a locked file shared by two
+    runs) are reported and treated as cache misses; the cache never fails a query.
+    """
+    
+    def __init__(self, path: str, ttl_seconds: float, max_entries: int):
+        """Open (or create) the cache database.
+        
+        Args:
+            path: Path to the SQLite database file
+            ttl_seconds: How long an answer stays valid
+            max_entries: Maximum number of answers kept on disk
+            
+        Raises:
+            sqlite3.Error: If the database cannot be opened or initialized
+        """
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            """CREATE TABLE IF NOT EXISTS answers (
+                key TEXT PRIMARY KEY,
+                answer TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            )"""
+        )
+        self.conn.commit()
+    
+    @staticmethod
+    def make_key(query: str, model: str, schema_hash: str) -> str:
+        """Build a cache key from the normalized query, model and tool-schema hash."""
+        normalized = " ".join(query.lower().split())
+        return hashlib.sha256(
+            json.dumps([normalized, model, schema_hash]).encode()
+        ).hexdigest()
+    
+    def get(self, key: str) -> Optional[str]:
+        """Return a cached answer, or None if missing, expired or unreadable."""
+        try:
+            return self._get(key)
+        except sqlite3.Error as e:
+            print(f"Warning: answer cache lookup failed: {e}")
+            self._rollback()
+            return None
+    
+    def put(self, key: str, answer: str) -> None:
+        """Store an answer, skipping it if the database cannot be written."""
+        try:
+            self._put(key, answer)
+        except sqlite3.Error as e:
+            print(f"Warning: answer cache write failed: {e}")
+            self._rollback()
+    
+    def _rollback(self) -> None:
+        try:
+            self.conn.rollback()
+        except sqlite3.Error:
+            pass
+    
+    def _get(self, key: str) -> Optional[str]:
+        now = time.time()
+        row = self.conn.execute(
+            "SELECT answer, created_at FROM answers WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        
+        answer, created_at = row
+        if now - created_at > self.ttl_seconds:
+            self.conn.execute("DELETE FROM answers WHERE key = ?", (key,))
+            self.conn.commit()
+            return None
+        
+        self.conn.execute("UPDATE answers SET last_used = ? WHERE key = ?", (now, key))
+        self.conn.commit()
+        return answer
+    
+    def _put(self, key: str, answer: str) -> None:
+        # Store the answer, then evict expired and least recently used entries over the limit
+        now = time.time()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO answers (key, answer, created_at, last_used) VALUES (?, ?, ?, ?)",
+            (key, answer, now, now)
+        )
+        self.conn.execute("DELETE FROM answers WHERE created_at < ?", (now - self.ttl_seconds,))
+        self.conn.execute(
+            """DELETE FROM answers WHERE key IN (
+                SELECT key FROM answers ORDER BY last_used DESC LIMIT -1 OFFSET ?
+            )""",
+            (self.max_entries,)
+        )
+        self.conn.commit()
+    
+    def close(self) -> None:
+        """Close the database connection."""
+        try:
+            self.conn.close()
+        except sqlite3.Error:
+            pass
+
 
 class GeminiMCPClient:
     """Enhanced Gemini MCP Client with improved error handling and structure."""
     
-    def __init__(self, server_script_path: str = "server.py", server_env: Optional[Dict[str, str]] = None):
+    def __init__(self, server_script_path: str = "server.py", server_env: Optional[Dict[str, str]] = None,
+                 cache_path: Optional[str] = ANSWER_CACHE_PATH):
         """Initialize the client with server configuration.
         
         Args:
             server_script_path: Path to the MCP server script
             server_env: Environment variables to pass to the server
+            cache_path: Path to the on-disk answer cache, or None/empty to disable it
         """
         self.server_params = StdioServerParameters(
             command="python",
             args=[server_script_path],
             env=server_env or {}
         )
+        self.cache = None
+        if cache_path:
+            try:
+                self.cache = AnswerCache(cache_path, ANSWER_CACHE_TTL_SECONDS, ANSWER_CACHE_MAX_ENTRIES)
+            except sqlite3.Error as e:
+                print(f"Warning: answer cache disabled, could not open {cache_path}: {e}")
+        # Formatted tools and their schema hash for the current session
+        self._session_tools: Optional[Tuple[ClientSession, List[types.Tool], str]] = None
+        # Gemini token usage, one record per uncached query
+        self.query_usage: List[Dict[str, Any]] = []
+    
+    async def _get_tools(self, session: ClientSession) -> Tuple[List[types.Tool], str]:
+        """List and format the session's tools once, returning them with a schema hash.
+        
+        Args:
+            session: Active MCP session
+            
+        Returns:
+            Tools formatted for Gemini and a hash of their MCP schemas
+        """
+        if self._session_tools and self._session_tools[0] is session:
+            return self._session_tools[1], self._session_tools[2]
+        
+        mcp_tools = await session.list_tools()
+        tools = self.format_tools_for_gemini(mcp_tools)
+        schema = [
+            [tool.name, tool.description, getattr(tool, 'inputSchema', None)]
+            for tool in mcp_tools.tools
+        ]
+        schema_hash = hashlib.sha256(
+            json.dumps(schema, sort_keys=True, default=str).encode()
+        ).hexdigest()
+        
+        self._session_tools = (session, tools, schema_hash)
+        return tools, schema_hash
         
     def format_tools_for_gemini(self, mcp_tools) -> List[types.Tool]:
         """Format MCP tools for Gemini API with improved schema handling.
@@ -87,11 +239,39 @@ class GeminiMCPClient:
         """
         try:
             # Get available tools
-            mcp_tools = await session.list_tools()
-            tools = self.format_tools_for_gemini(mcp_tools)
+            tools, schema_hash = await self._get_tools(session)
             
             print(f"\nProcessing query: {query}")
             
+            cache_key = AnswerCache.make_key(query, model, schema_hash)
+            if self.cache:
+                cached = self.cache.get(cache_key)
+                if cached is not None:
+                    print("Answer served from cache")
+                    return cached
+            
+            answer, cacheable = await self._generate_answer(session, query, model, tools)
+            if self.cache and cacheable:
+                self.cache.put(cache_key, answer)
+            return answer
+            
+        except Exception as e:
+            return f"Error processing query: {str(e)}"
+
+    async def _generate_answer(self, session: ClientSession, query: str, model: str,
+                               tools: List[types.Tool]) -> Tuple[str, bool]:
+        """Ask Gemini to answer the query, executing any tool call it makes.
+        
+        Args:
+            session: Active MCP session
+            query: The user query
+            model: Gemini model to use
+            tools: Tools formatted for Gemini
+            
+        Returns:
+            The answer and whether it is safe to cache (errors are not)
+        """
+        try:
             # Enhanced prompt to encourage tool usage
             enhanced_query = f"""
 You have access to company knowledge base tools. Please use the available tools to search for information about: {query}
@@ -118,9 +298,11 @@ User question: {query}
                 ),
             )
             
+            self._record_usage(query, model, response)
+            
             # Process the response
             if not response.candidates:
-                return "Error: No response candidates from Gemini"
+                return "Error: No response candidates from Gemini", False
                 
             candidate = response.candidates[0]
             
@@ -146,48 +328,131 @@ User question: {query}
                         return self._format_tool_result(result)
                         
                     except Exception as e:
-                        return f"Error executing tool {function_call.name}: {str(e)}"
+                        return f"Error executing tool {function_call.name}: {str(e)}", False
             
             # If no function call, return direct text response
             if candidate.content.parts:
                 text_parts = [part.text for part in candidate.content.parts if hasattr(part, 'text')]
                 if text_parts:
-                    return '\n'.join(text_parts)
+                    return '\n'.join(text_parts), True
             
             # Fallback to response.text if available
             if hasattr(response, 'text') and response.text:
-                return response.text
+                return response.text, True
                 
-            return "No meaningful response generated"
+            return "No meaningful response generated", False
             
         except Exception as e:
-            return f"Error processing query: {str(e)}"
+            return f"Error processing query: {str(e)}", False
+
+    def _record_usage(self, query: str, model: str, response) -> None:
+        """Record the token usage of one Gemini call, tagged with the tool it selected.
+        
+        Args:
+            query: The user query
+            model: Gemini model used
+            response: The Gemini response
+        """
+        meta = getattr(response, 'usage_metadata', None)
+        tool = None
+        if response.candidates and response.candidates[0].content.parts:
+            function_call = getattr(response.candidates[0].content.parts[0], 'function_call', None)
+            tool = function_call.name if function_call else None
+        
+        usage = {
+            "query": query,
+            "model": model,
+            "tool": tool,
+            "input_tokens": getattr(meta, 'prompt_token_count', None) or 0,
+            "output_tokens": getattr(meta, 'candidates_token_count', None) or 0,
+        }
+        self.query_usage.append(usage)
+        print(f"Token usage: {usage['input_tokens']} in / {usage['output_tokens']} out")
+    
+    def usage_by_tool(self) -> Dict[str, Dict[str, int]]:
+        """Aggregate recorded token usage per selected tool ("none" for direct answers)."""
+        totals: Dict[str, Dict[str, int]] = {}
+        for usage in self.query_usage:
+            entry = totals.setdefault(
+                usage["tool"] or "none", {"queries": 0, "input_tokens": 0, "output_tokens": 0}
+            )
+            entry["queries"] += 1
+            entry["input_tokens"] += usage["input_tokens"]
+            entry["output_tokens"] += usage["output_tokens"]
+        return totals
+    
+    def print_usage_summary(self):
+        """Print Gemini token usage per tool for this run."""
+        if not self.query_usage:
+            return
+        print("\nGemini token usage by tool:")
+        for tool, totals in self.usage_by_tool().items():
+            print(f"  - {tool}: {totals['queries']} queries, "
+                  f"{totals['input_tokens']} in / {totals['output_tokens']} out")
 
-    def _format_tool_result(self, result) -> str:
+    def _format_tool_result(self, result) -> Tuple[str, bool]:
         """Format tool execution result for display.
         
         Args:
             result: The result from MCP tool execution
             
         Returns:
-            Formatted result string
+            Formatted result string and whether it is safe to cache. Tool errors,
+            structured errors and degraded (keyword-only) answers are not.
         """
         try:
+            cacheable = not getattr(result, 'isError', False)
+            
             if hasattr(result, 'content') and result.content:
                 content_text = result.content[0].text if hasattr(result.content[0], 'text') else str(result.content[0])
                 
-                # Try to parse and format as JSON
+                # The server flags keyword-search fallbacks in the content's _meta
+                meta = getattr(result.content[0], 'meta', None) or {}
+                cacheable = cacheable and not meta.get("degraded")
+                
+                # Only structured results are JSON; everything else is plain text
+                if not content_text.startswith("{"):
+                    return content_text, cacheable
+                
                 try:
                     parsed_json = json.loads(content_text)
-                    return json.dumps(parsed_json, indent=2)
                 except json.JSONDecodeError:
-                    # Return as plain text if not valid JSON
-                    return content_text
+                    return content_text, cacheable
+                
+                cacheable = cacheable and "error" not in parsed_json
+                return self._format_structured_result(parsed_json), cacheable
             
-            return str(result)
+            return str(result), False
             
         except Exception as e:
-            return f"Error formatting result: {str(e)}"
+            return f"Error formatting result: {str(e)}", False
+
+    def _format_structured_result(self, payload: Dict[str, Any]) -> str:
+        """Render a structured knowledge base page as readable text.
+        
+        Args:
+            payload: Parsed JSON result with "results" and "next_cursor"
+            
+        Returns:
+            Formatted result string
+        """
+        if "error" in payload:
+            return f"Error: {payload['error']}"
+        
+        lines = []
+        for item in payload.get("results", []):
+            header = f"[{item.get('id')}] (score {item.get('score')})"
+            if "question" in item:
+                lines.append(f"{header} Q: {item['question']}\nA: {item.get('answer', '')}")
+            else:
+                lines.append(header)
+        
+        if not lines:
+            lines.append("No matching entries found.")
+        if payload.get("next_cursor"):
+            lines.append(f"(more results: cursor={payload['next_cursor']}, total={payload.get('total')})")
+        
+        return "\n\n".join(lines)
 
     async def run_interactive_session(self):
         """Run an interactive session with the MCP server."""
@@ -230,6 +495,8 @@ User question: {query}
                         except Exception as e:
                             print(f"Error: {e}")
                             continue
+                    
+                    self.print_usage_summary()
                             
         except Exception as e:
             print(f"Failed to connect to MCP server: {e}")
@@ -271,6 +538,8 @@ User question: {query}
                         except Exception as e:
                             print(f"Error processing query {i}: {e}")
                             continue
+                    
+                    self.print_usage_summary()
                             
         except Exception as e:
             print(f"Failed to connect to MCP server: {e}")
@@ -300,6 +569,9 @@ async def main():
         print("\n\nShutting down gracefully...")
     except Exception as e:
         print(f"Unexpected error: {e}")
+    finally:
+        if client_instance.cache:
+            client_instance.cache.close()
 
 
 if __name__ == "__main__":
@@ -1,22 +1,145 @@
 import os
+import re
 import json
 import sys
+import atexit
+import asyncio
+import hashlib
+import queue
+import random
 import logging
-from typing import Optional
-from mcp.server.fastmcp import FastMCP
+from logging.handlers import QueueHandler, QueueListener
+from collections import OrderedDict, defaultdict
+from contextlib import asynccontextmanager
+from typing import List, Optional, Tuple
+from mcp.server.fastmcp import Context, FastMCP
+from mcp.server.fastmcp.exceptions import ToolError
+from mcp.types import TextContent
 from google import genai
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv("../.env")
 
+# Logging settings
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')  # "json" or "text"
+LOG_REQUEST_SAMPLE_RATE = float(os.getenv('LOG_REQUEST_SAMPLE_RATE', '0.1'))
+LOG_QUEUE_SIZE = 10000
+
+# Attributes every LogRecord has; anything else was passed via `extra=`
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as one JSON object per line, including `extra=` fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class SampledLogger(logging.Logger):
+    """Logger that keeps a fraction of messages below WARNING; warnings and errors always pass.
+
+    Sampling happens in isEnabledFor, so a sampled-out call returns before the
+    LogRecord is built (no findCaller or makeRecord).
+    """
+
+    sample_rate = 1.0
+
+    def isEnabledFor(self, level: int) -> bool:
+        if not super().isEnabledFor(level):
+            return False
+        return level >= logging.WARNING or random.random() < self.sample_rate
+
+
+class _NonBlockingQueueHandler(QueueHandler):
+    """Hand records to the background writer without formatting.
+
+    Formatting happens on the listener thread. When the queue is full, records
+    below WARNING are dropped rather than stalling the request and reported as
+    a count once there is room again; warnings and errors wait for space.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        if self.dropped:
+            self._report_dropped()
+        if record.levelno >= logging.WARNING:
+            self.queue.put(record)
+            return
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _report_dropped(self) -> None:
+        notice = logging.makeLogRecord({
+            "name": LOGGER_NAME,
+            "levelno": logging.WARNING,
+            "levelname": "WARNING",
+            "msg": "Dropped %d log records because the log queue was full",
+            "args": (self.dropped,),
+        })
+        try:
+            self.queue.put_nowait(notice)
+            self.dropped = 0
+        except queue.Full:
+            pass
+
+
+def setup_logging() -> QueueListener:
+    """Route all logging through a queue to a background stderr writer.
+
+    stdout carries the MCP protocol on the stdio transport, so logs go to stderr.
+    """
+    stream_handler = logging.StreamHandler(sys.stderr)
+    if LOG_FORMAT == 'json':
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(
+            logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        )
+
+    log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    root = logging.getLogger()
+    root.handlers = [_NonBlockingQueueHandler(log_queue)]
+    root.setLevel(LOG_LEVEL)
+
+    listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
 # Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    stream=sys.stdout
-)
-logger = logging.getLogger(__name__)
+log_listener = setup_logging()
+# Fixed name rather than __name__, which is "__main__" when run as `python server.py`
+LOGGER_NAME = "server"
+logger = logging.getLogger(LOGGER_NAME)
+
+# Per-request messages are sampled to keep the hot path cheap
+SampledLogger.sample_rate = LOG_REQUEST_SAMPLE_RATE
+logging.setLoggerClass(SampledLogger)
+request_logger = logging.getLogger(f"{LOGGER_NAME}.request")
+logging.setLoggerClass(logging.Logger)
 
 # Create an MCP server
 logger.info("Initializing MCP server...")
@@ -33,7 +156,11 @@ except Exception as e:
 
 
 def load_knowledge_base():
-    """Load and cache the knowledge base."""
+    """Load the default knowledge base, creating a sample one if it is missing.
+
+    Raises:
+        KnowledgeBaseError: If the file exists but cannot be read or parsed.
+    """
     try:
         current_dir = os.path.dirname(os.path.abspath(__file__))
         kb_path = os.path.join(current_dir, "knowledge_base.json")
@@ -76,11 +203,205 @@ def load_knowledge_base():
             
     except Exception as e:
         logger.error(f"Error loading knowledge base: {e}")
-        return {"qa_pairs": []}
+        raise KnowledgeBaseError(f"Knowledge base '{DEFAULT_TENANT}' could not be loaded")
+
+
+# Token budget settings
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', '8000'))
+MAX_OUTPUT_TOKENS = int(os.getenv('MAX_OUTPUT_TOKENS', '1024'))
+CHARS_PER_TOKEN = 4
+
+usage_logger = logging.getLogger(f"{LOGGER_NAME}.usage")
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheaply estimate the token count of a prompt fragment (about 4 characters per token)."""
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+class UsageTracker:
+    """Accumulate Gemini token usage per tool, and log each call.
+
+    Reported counts (from the response's usage_metadata) and our own input
+    estimates are kept separately; calls that reported no usage are counted in
+    "unreported_calls" rather than filled in with the estimate.
+    """
+
+    def __init__(self):
+        self.by_tool = defaultdict(lambda: {
+            "calls": 0, "unreported_calls": 0, "estimated_input_tokens": 0,
+            "input_tokens": 0, "output_tokens": 0
+        })
+
+    def record(self, tool: str, operation: str, estimated_input: int, response, **fields) -> None:
+        """Record one Gemini call.
+
+        Args:
+            tool: MCP tool the call was made for
+            operation: What the call did, e.g. "search" or "rank"
+            estimated_input: Estimated prompt tokens
+            response: The Gemini response, whose usage_metadata is read if present
+            **fields: Extra per-query fields to include in the usage log
+        """
+        meta = getattr(response, 'usage_metadata', None)
+        input_tokens = getattr(meta, 'prompt_token_count', None)
+        output_tokens = getattr(meta, 'candidates_token_count', None)
+
+        totals = self.by_tool[tool]
+        totals["calls"] += 1
+        totals["estimated_input_tokens"] += estimated_input
+        if input_tokens is None and output_tokens is None:
+            totals["unreported_calls"] += 1
+        totals["input_tokens"] += input_tokens or 0
+        totals["output_tokens"] += output_tokens or 0
+
+        usage_logger.info("gemini call", extra={
+            "tool": tool,
+            "operation": operation,
+            "estimated_input_tokens": estimated_input,
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            **fields,
+        })
+
+    def snapshot(self) -> dict:
+        """Return per-tool totals."""
+        return {tool: dict(totals) for tool, totals in self.by_tool.items()}
+
+
+usage_tracker = UsageTracker()
+
+
+# Multi-tenant settings
+DEFAULT_TENANT = "default"
+KB_DIR = os.getenv('KB_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
+KB_MEMORY_BUDGET_MB = float(os.getenv('KB_MEMORY_BUDGET_MB', '256'))
+RANKING_CACHE_SIZE = 128
+# Rough per-entry footprint of a cached ranking: an (id, score) tuple in a list
+RANKING_ENTRY_BYTES = 64
+
+_TENANT_NAME = re.compile(r"^[A-Za-z0-9_-]+$")
+
+
+class PromptListing:
+    """Numbered knowledge base entries for a Gemini prompt, with per-entry token estimates."""
+
+    def __init__(self, entries: List[str], separator: str):
+        self.entries = entries
+        self.separator = separator
+        self.text = separator.join(entries)
+        self.entry_tokens = [estimate_tokens(entry) for entry in entries]
+        self.total_tokens = estimate_tokens(self.text)
+        self.truncation_warned = False
 
 
-# Load knowledge base at startup
-KNOWLEDGE_BASE = load_knowledge_base()
+class KnowledgeBaseError(Exception):
+    """Raised when a tenant's knowledge base cannot be loaded."""
+
+
+class UnknownTenantError(KnowledgeBaseError):
+    """Raised when no knowledge base exists for the requested tenant."""
+
+
+class KnowledgeBase:
+    """One tenant's Q&A pairs plus the search indexes built from them."""
+
+    def __init__(self, name: str, qa_pairs: List[dict]):
+        self.name = name
+        self.qa_pairs = qa_pairs
+        # Lowercased "question answer" text per entry, for keyword search
+        self.search_texts = [
+            f"{qa.get('question', '')} {qa.get('answer', '')}".lower() for qa in qa_pairs
+        ]
+        # Numbered listings used in Gemini prompts
+        self.qa_listing = PromptListing([
+            f"{i}. Q: {qa.get('question', '')}\n   A: {qa.get('answer', '')}"
+            for i, qa in enumerate(qa_pairs, 1)
+        ], "\n\n")
+        self.question_listing = PromptListing([
+            f"{i}. {qa.get('question', '')}" for i, qa in enumerate(qa_pairs, 1)
+        ], "\n")
+        # Recent rankings keyed by query, so cursor pages don't re-run the search
+        self.rankings: "OrderedDict[str, List[Tuple[int, float]]]" = OrderedDict()
+        # Recent free-text semantic answers keyed by query, served without a Gemini call
+        self.answers: "OrderedDict[str, str]" = OrderedDict()
+        # Rough footprint: raw text plus the derived indexes above, and the two caches
+        self.index_bytes = 2 * sum(len(text) for text in self.search_texts) + \
+            len(self.qa_listing.text) + len(self.question_listing.text)
+        self.cache_bytes = 0
+
+    @property
+    def size_bytes(self) -> int:
+        return self.index_bytes + self.cache_bytes
+
+
+class KnowledgeBaseRegistry:
+    """Load tenant knowledge bases on first use and evict idle ones under a memory budget.
+
+    The default tenant is `knowledge_base.json` next to this file; every other
+    tenant is `<KB_DIR>/<tenant>.json`.
+    """
+
+    def __init__(self, kb_dir: str, memory_budget_bytes: int):
+        self.kb_dir = kb_dir
+        self.memory_budget_bytes = memory_budget_bytes
+        self._loaded: "OrderedDict[str, KnowledgeBase]" = OrderedDict()
+
+    def get(self, tenant: Optional[str] = None) -> KnowledgeBase:
+        """Return the knowledge base for a tenant, loading it if needed.
+
+        Raises:
+            UnknownTenantError: If the tenant name is invalid or has no file.
+            KnowledgeBaseError: If the tenant's file is unreadable or malformed.
+        """
+        tenant = tenant or DEFAULT_TENANT
+        if tenant in self._loaded:
+            self._loaded.move_to_end(tenant)
+            return self._loaded[tenant]
+
+        kb = self._load(tenant)
+        self._loaded[tenant] = kb
+        self.enforce_budget()
+        return kb
+
+    def _load(self, tenant: str) -> KnowledgeBase:
+        if tenant == DEFAULT_TENANT:
+            data = load_knowledge_base()
+        else:
+            if not _TENANT_NAME.match(tenant):
+                raise UnknownTenantError(f"Invalid knowledge base name: {tenant}")
+            kb_path = os.path.join(self.kb_dir, f"{tenant}.json")
+            if not os.path.exists(kb_path):
+                raise UnknownTenantError(f"Unknown knowledge base: {tenant}")
+            logger.info(f"Loading knowledge base '{tenant}' from: {kb_path}")
+            try:
+                with open(kb_path, 'r') as f:
+                    data = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.error(f"Could not read knowledge base '{tenant}' from {kb_path}: {e}")
+                raise KnowledgeBaseError(f"Knowledge base '{tenant}' could not be loaded")
+
+        # Accept both {"qa_pairs": [...]} and a bare list of Q&A pairs
+        qa_pairs = data if isinstance(data, list) else \
+            data.get('qa_pairs') if isinstance(data, dict) else None
+        if not isinstance(qa_pairs, list) or not all(isinstance(qa, dict) for qa in qa_pairs):
+            logger.error(f"Knowledge base '{tenant}' is malformed: expected a list of Q&A objects")
+            raise KnowledgeBaseError(f"Knowledge base '{tenant}' is malformed")
+        return KnowledgeBase(tenant, qa_pairs)
+
+    def enforce_budget(self) -> None:
+        """Drop least recently used knowledge bases until under budget, keeping the newest.
+
+        Called after a load and whenever a knowledge base's caches grow.
+        """
+        total = sum(kb.size_bytes for kb in self._loaded.values())
+        while total > self.memory_budget_bytes and len(self._loaded) > 1:
+            tenant, kb = self._loaded.popitem(last=False)
+            total -= kb.size_bytes
+            logger.info(f"Evicted knowledge base '{tenant}' ({kb.size_bytes} bytes)")
+
+
+knowledge_bases = KnowledgeBaseRegistry(KB_DIR, int(KB_MEMORY_BUDGET_MB * 1024 * 1024))
 
 # Initialize Gemini client for semantic search
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
@@ -92,8 +413,102 @@ else:
     logger.warning("GEMINI_API_KEY not found - falling back to keyword search")
 
 
+# Structured result defaults
+DEFAULT_TOP_K = 5
+MAX_TOP_K = 50
+
+# Admission control settings for Gemini-backed searches
+MAX_CONCURRENT_SEARCHES = int(os.getenv('MAX_CONCURRENT_SEARCHES', '8'))
+MAX_QUEUED_SEARCHES = int(os.getenv('MAX_QUEUED_SEARCHES', '32'))
+PER_CLIENT_LIMIT = int(os.getenv('PER_CLIENT_LIMIT', '4'))
+QUEUE_TIMEOUT_SECONDS = float(os.getenv('QUEUE_TIMEOUT_SECONDS', '2.0'))
+OVERLOAD_MODE = os.getenv('OVERLOAD_MODE', 'degrade')  # "degrade" or "reject"
+
+OVERLOADED_MESSAGE = "The knowledge base server is busy. Please try again shortly."
+# Shown to readers of free-text answers that fell back to keyword search. Clients should
+# detect degraded answers through the result's _meta ({"degraded": true}), not this text.
+DEGRADED_NOTE = "Note: semantic search was unavailable, so this answer comes from keyword search only."
+
+
+class OverloadedError(Exception):
+    """Raised when a search cannot be admitted within the configured limits."""
+
+
+class AdmissionController:
+    """Bound concurrent Gemini searches, the wait queue, and in-flight work per client."""
+
+    def __init__(self, max_concurrent: int, max_queued: int, per_client_limit: int, queue_timeout: float):
+        self.max_queued = max_queued
+        self.per_client_limit = per_client_limit
+        self.queue_timeout = queue_timeout
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._waiting = 0
+        self._per_client = defaultdict(int)
+
+    @asynccontextmanager
+    async def slot(self, client_id: str):
+        """Hold a search slot for the duration of the block.
+
+        Raises:
+            OverloadedError: If the client is over its limit, the queue is full,
+                or no slot frees up within the queue timeout.
+        """
+        if self._per_client[client_id] >= self.per_client_limit:
+            raise OverloadedError(f"client {client_id} has {self.per_client_limit} searches in flight")
+        if self._waiting >= self.max_queued:
+            raise OverloadedError("search queue is full")
+
+        self._per_client[client_id] += 1
+        self._waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+        except BaseException as e:
+            # Timed out or cancelled while waiting: give the client slot back
+            self._release_client(client_id)
+            if isinstance(e, asyncio.TimeoutError):
+                raise OverloadedError(f"queue wait exceeded {self.queue_timeout}s")
+            raise
+        finally:
+            self._waiting -= 1
+
+        try:
+            yield
+        finally:
+            self._semaphore.release()
+            self._release_client(client_id)
+
+    def _release_client(self, client_id: str) -> None:
+        self._per_client[client_id] -= 1
+        if self._per_client[client_id] <= 0:
+            del self._per_client[client_id]
+
+
+admission = AdmissionController(
+    MAX_CONCURRENT_SEARCHES, MAX_QUEUED_SEARCHES, PER_CLIENT_LIMIT, QUEUE_TIMEOUT_SECONDS
+)
+
+
+def _client_id(ctx: Optional[Context]) -> str:
+    """Identify the calling client, falling back to its session."""
+    if ctx is None:
+        return "local"
+    try:
+        return ctx.client_id or f"session-{id(ctx.session)}"
+    except ValueError:
+        # No active request context
+        return "local"
+
+
 @mcp.tool()
-async def get_knowledge_base(query: str) -> str:
+async def get_knowledge_base(
+    query: str,
+    structured: bool = False,
+    top_k: int = DEFAULT_TOP_K,
+    cursor: Optional[str] = None,
+    ids_only: bool = False,
+    tenant: Optional[str] = None,
+    ctx: Context = None,
+) -> TextContent:
     """Search and retrieve information from the company knowledge base using LLM-powered semantic search.
     
     This tool uses advanced AI to understand your question and find the most relevant information
@@ -112,41 +527,154 @@ async def get_knowledge_base(query: str) -> str:
     
     Args:
         query: The user's question about company policies or information
+        structured: Return a compact JSON page of ranked entries instead of free text
+        top_k: Maximum number of entries per page (structured mode only)
+        cursor: Opaque cursor from a previous page's "next_cursor" (structured mode only)
+        ids_only: Return only entry ids and scores, without question/answer text
+        tenant: Name of the department knowledge base to search (defaults to the company-wide one)
     
     Returns:
-        The most relevant information from the knowledge base based on semantic understanding
+        The most relevant information from the knowledge base based on semantic understanding.
+        Answers that fell back to keyword search carry _meta {"degraded": true}.
+
+    Raises:
+        ToolError: In free-text mode, if the knowledge base is unavailable or the
+            server is too busy. Structured mode reports errors as {"error": ...}.
     """
-    logger.info(f"get_knowledge_base called with query: {query}")
+    request_logger.info("get_knowledge_base called", extra={"query_len": len(query), "structured": structured})
+    client_id = _client_id(ctx)
+    structured = structured or ids_only or cursor is not None
     
     try:
-        if not KNOWLEDGE_BASE.get('qa_pairs'):
-            return "Knowledge base is empty or not available."
+        try:
+            kb = knowledge_bases.get(tenant)
+        except KnowledgeBaseError as e:
+            if structured:
+                return _content(json.dumps({"error": str(e)}))
+            raise ToolError(str(e))
+
+        if not kb.qa_pairs:
+            if structured:
+                return _content(json.dumps({"error": "Knowledge base is empty or not available."}))
+            raise ToolError("Knowledge base is empty or not available.")
+
+        if structured:
+            return _content(*await _structured_search(kb, query, top_k, cursor, ids_only, client_id))
         
-        # Use LLM-powered semantic search if available
-        if gemini_client:
-            return await _semantic_search(query)
-        else:
-            # Fallback to keyword search
-            return _keyword_search(query)
+        # Keyword search is local and cheap, so it never waits for a slot
+        if not gemini_client:
+            return _content(_keyword_search(kb, query))
+
+        # Neither do answers we already have
+        key = _query_key(query)
+        if key in kb.answers:
+            kb.answers.move_to_end(key)
+            return _content(kb.answers[key])
+
+        try:
+            async with admission.slot(client_id):
+                answer = await _semantic_search(kb, query)
+            if answer is None:
+                return _content(_degraded_keyword_search(kb, query), degraded=True)
+            _lru_put(kb, kb.answers, key, answer)
+            return _content(answer)
+        except OverloadedError as e:
+            logger.warning(f"Search not admitted: {e}")
+            if OVERLOAD_MODE == 'reject':
+                raise ToolError(OVERLOADED_MESSAGE)
+            return _content(_degraded_keyword_search(kb, query), degraded=True)
             
+    except ToolError:
+        raise
     except Exception as e:
         error_msg = f"Error accessing knowledge base: {str(e)}"
         logger.error(error_msg, exc_info=True)
-        return error_msg
+        if structured:
+            return _content(json.dumps({"error": error_msg}))
+        raise ToolError(error_msg) from e
+
+
+def _content(text: str, degraded: bool = False) -> TextContent:
+    """Wrap a tool answer, flagging keyword-search fallbacks in _meta."""
+    return TextContent(type="text", text=text, _meta={"degraded": True} if degraded else None)
+
+
+def _query_key(query: str) -> str:
+    """Normalize a query for use as a cache key."""
+    return " ".join(query.lower().split())
+
+
+def _cache_entry_bytes(key: str, value) -> int:
+    """Approximate footprint of one cached answer (str) or ranking (list of tuples)."""
+    if isinstance(value, str):
+        return len(key) + len(value)
+    return len(key) + RANKING_ENTRY_BYTES * len(value)
+
 
+def _lru_put(kb: KnowledgeBase, cache: OrderedDict, key: str, value) -> None:
+    """Insert into one of kb's LRU caches, keeping kb.cache_bytes and the memory budget in step.
 
-async def _semantic_search(query: str) -> str:
-    """Use Gemini LLM for semantic search through the knowledge base."""
+    Drops the oldest entry past RANKING_CACHE_SIZE.
+    """
+    if key in cache:
+        kb.cache_bytes -= _cache_entry_bytes(key, cache[key])
+    cache[key] = value
+    cache.move_to_end(key)
+    kb.cache_bytes += _cache_entry_bytes(key, value)
+    while len(cache) > RANKING_CACHE_SIZE:
+        old_key, old_value = cache.popitem(last=False)
+        kb.cache_bytes -= _cache_entry_bytes(old_key, old_value)
+    knowledge_bases.enforce_budget()
+
+
+async def _semantic_search(kb: KnowledgeBase, query: str) -> Optional[str]:
+    """Use Gemini LLM for semantic search through the knowledge base.
+
+    Returns:
+        Gemini's answer, or None if it failed and the caller should fall back.
+    """
     try:
-        # Prepare the knowledge base content for the LLM
-        kb_content = []
-        for i, qa in enumerate(KNOWLEDGE_BASE.get('qa_pairs', []), 1):
-            kb_content.append(f"{i}. Q: {qa.get('question', '')}\n   A: {qa.get('answer', '')}")
-        
-        kb_text = "\n\n".join(kb_content)
+        # Fit the knowledge base into the prompt budget, most relevant entries first
+        context_budget = PROMPT_TOKEN_BUDGET - estimate_tokens(_search_prompt(query, ""))
+        kb_text = _fit_context(kb, query, kb.qa_listing, context_budget)
+        if kb_text is None:
+            return None
+        search_prompt = _search_prompt(query, kb_text)
+
+        # Call Gemini for semantic search
+        response = await gemini_client.aio.models.generate_content(
+            model="gemini-1.5-flash",
+            contents=search_prompt,
+            config={
+                "temperature": 0.1,  # Low temperature for consistent, factual responses
+                "max_output_tokens": MAX_OUTPUT_TOKENS
+            }
+        )
+        usage_tracker.record(
+            "get_knowledge_base", "search", estimate_tokens(search_prompt), response,
+            tenant=kb.name, query_hash=_fingerprint(_query_key(query)), query_len=len(query)
+        )
         
-        # Create a semantic search prompt
-        search_prompt = f"""You are a helpful company knowledge base assistant. A user has asked a question, and you need to find the most relevant information from our company knowledge base.
+        if response and hasattr(response, 'text') and response.text:
+            request_logger.info("Semantic search completed successfully")
+            return response.text.strip()
+        else:
+            logger.warning("No response from Gemini, falling back to keyword search")
+            return None
+            
+    except Exception as e:
+        logger.error(f"Error in semantic search: {e}")
+        return None
+
+
+def _degraded_keyword_search(kb: KnowledgeBase, query: str) -> str:
+    """Keyword search used in place of semantic search, marked with DEGRADED_NOTE."""
+    return f"{DEGRADED_NOTE}\n\n{_keyword_search(kb, query)}"
+
+
+def _search_prompt(query: str, kb_text: str) -> str:
+    """Build the semantic search prompt."""
+    return f"""You are a helpful company knowledge base assistant. A user has asked a question, and you need to find the most relevant information from our company knowledge base.
 
 User Question: "{query}"
 
@@ -169,31 +697,54 @@ Instructions:
 
 Please provide your response now."""
 
-        # Call Gemini for semantic search
-        response = gemini_client.models.generate_content(
-            model="gemini-1.5-flash",
-            contents=search_prompt,
-            config={
-                "temperature": 0.1,  # Low temperature for consistent, factual responses
-                "max_output_tokens": 1024
-            }
-        )
-        
-        if response and hasattr(response, 'text') and response.text:
-            logger.info("Semantic search completed successfully")
-            return response.text.strip()
-        else:
-            logger.warning("No response from Gemini, falling back to keyword search")
-            return _keyword_search(query)
-            
-    except Exception as e:
-        logger.error(f"Error in semantic search: {e}")
-        return _keyword_search(query)
 
+def _fit_context(kb: KnowledgeBase, query: str, listing: PromptListing, budget: int) -> Optional[str]:
+    """Return the listing text, dropping the least relevant entries if it exceeds the budget.
+
+    Entries are taken in keyword-relevance order, then in knowledge base order,
+    and keep their original numbering so ids in Gemini's answer stay valid.
+    Truncation is warned about once per listing; later occurrences go to the
+    sampled request logger.
+
+    Returns:
+        The (possibly truncated) listing, or None if not a single entry fits,
+        in which case the caller should not call Gemini.
+    """
+    if listing.total_tokens <= budget:
+        return listing.text
+
+    ranked = [entry_id - 1 for entry_id, _ in _keyword_scores(kb, query)]
+    ranked_set = set(ranked)
+    order = ranked + [i for i in range(len(listing.entries)) if i not in ranked_set]
+
+    chosen = []
+    used = 0
+    for i in order:
+        cost = listing.entry_tokens[i]
+        if used + cost <= budget:
+            chosen.append(i)
+            used += cost
 
-def _keyword_search(query: str) -> str:
+    if chosen:
+        message = (f"Prompt context for '{kb.name}' truncated to {len(chosen)}/{len(listing.entries)} "
+                   f"entries to fit {budget} tokens")
+    else:
+        message = (f"No '{kb.name}' entries fit the prompt budget ({budget} tokens left after the "
+                   f"prompt itself); raise PROMPT_TOKEN_BUDGET")
+    if listing.truncation_warned:
+        request_logger.info(message)
+    else:
+        logger.warning(message)
+        listing.truncation_warned = True
+
+    if not chosen:
+        return None
+    return listing.separator.join(listing.entries[i] for i in sorted(chosen))
+
+
+def _keyword_search(kb: KnowledgeBase, query: str) -> str:
     """Fallback keyword-based search method."""
-    logger.info("Using keyword search fallback")
+    request_logger.info("Using keyword search fallback")
     
     query_lower = query.lower()
     relevant_answers = []
@@ -207,34 +758,218 @@ def _keyword_search(query: str) -> str:
     ]
     
     # Search through Q&A pairs for relevant information
-    for qa in KNOWLEDGE_BASE.get('qa_pairs', []):
-        question = qa.get('question', '').lower()
-        answer = qa.get('answer', '').lower()
-        
+    for qa, text in zip(kb.qa_pairs, kb.search_texts):
         # Check if any query keywords match with question or answer content
         for keyword in query_keywords:
-            if keyword in query_lower and (keyword in question or keyword in answer):
+            if keyword in query_lower and keyword in text:
                 relevant_answers.append(f"Q: {qa.get('question', '')}\nA: {qa.get('answer', '')}")
                 break
     
     if relevant_answers:
         result = "Here's what I found in the company knowledge base:\n\n" + \
                 "\n\n".join(relevant_answers)
-        logger.info("Found relevant information using keyword search")
+        request_logger.info("Found relevant information using keyword search")
         return result
     else:
         # If no specific match, return limited information
         formatted_info = "I couldn't find specific information about that query. Here are some available topics:\n\n"
         
-        for i, qa in enumerate(KNOWLEDGE_BASE.get('qa_pairs', [])[:5], 1):  # Limit to first 5
+        for i, qa in enumerate(kb.qa_pairs[:5], 1):  # Limit to first 5
             question = qa.get('question', '')
             formatted_info += f"{i}. {question}\n"
         
-        formatted_info += f"\nTotal topics available: {len(KNOWLEDGE_BASE.get('qa_pairs', []))}"
-        logger.info("No specific match found, returning topic list")
+        formatted_info += f"\nTotal topics available: {len(kb.qa_pairs)}"
+        request_logger.info("No specific match found, returning topic list")
         return formatted_info
 
 
+def _keyword_scores(kb: KnowledgeBase, query: str) -> List[Tuple[int, float]]:
+    """Score Q&A pairs by the fraction of query terms they contain.
+
+    Returns:
+        (id, score) tuples for matching entries, best first. Ids are 1-based
+        positions in the knowledge base.
+    """
+    terms = {t.strip("?.,!:;'\"()").lower() for t in query.split()}
+    terms = {t for t in terms if len(t) > 2}
+    if not terms:
+        return []
+
+    scores = []
+    for i, text in enumerate(kb.search_texts, 1):
+        hits = sum(1 for term in terms if term in text)
+        if hits:
+            scores.append((i, round(hits / len(terms), 3)))
+
+    scores.sort(key=lambda item: (-item[1], item[0]))
+    return scores
+
+
+async def _semantic_scores(kb: KnowledgeBase, query: str) -> Optional[List[Tuple[int, float]]]:
+    """Ask Gemini to rank Q&A pairs by relevance, or return None if it fails."""
+    context_budget = PROMPT_TOKEN_BUDGET - estimate_tokens(_rank_prompt(query, ""))
+    kb_text = _fit_context(kb, query, kb.question_listing, context_budget)
+    if kb_text is None:
+        return None
+    rank_prompt = _rank_prompt(query, kb_text)
+
+    try:
+        response = await gemini_client.aio.models.generate_content(
+            model="gemini-1.5-flash",
+            contents=rank_prompt,
+            config={
+                "temperature": 0,
+                "max_output_tokens": MAX_OUTPUT_TOKENS,
+                "response_mime_type": "application/json"
+            }
+        )
+        usage_tracker.record(
+            "get_knowledge_base", "rank", estimate_tokens(rank_prompt), response,
+            tenant=kb.name, query_hash=_fingerprint(_query_key(query)), query_len=len(query)
+        )
+        ranked = json.loads(response.text)
+        scores = []
+        seen = set()
+        for item in ranked:
+            entry_id = int(item["id"])
+            # Keep only the first occurrence of an id, so pages never repeat entries
+            if 1 <= entry_id <= len(kb.qa_pairs) and entry_id not in seen:
+                seen.add(entry_id)
+                scores.append((entry_id, round(float(item.get("score", 0)), 3)))
+        return scores
+    except Exception as e:
+        logger.error(f"Error in semantic ranking: {e}")
+        return None
+
+
+def _rank_prompt(query: str, kb_text: str) -> str:
+    """Build the relevance ranking prompt."""
+    return f"""Rank the knowledge base questions below by how well they answer the user's question.
+
+User Question: "{query}"
+
+Knowledge Base Questions:
+{kb_text}
+
+Return only a JSON array of objects like {{"id": 3, "score": 0.9}}, most relevant first.
+Scores are between 0 and 1. Omit entries that are not relevant."""
+
+
+async def _rank(kb: KnowledgeBase, query: str, client_id: str) -> Tuple[List[Tuple[int, float]], bool]:
+    """Return the ranking for a query, reusing a recent one when available.
+
+    Cached and keyword rankings are served immediately; only Gemini ranking
+    goes through admission control. Free-text answers get the same treatment
+    through kb.answers in get_knowledge_base.
+
+    Returns:
+        The (id, score) ranking and whether it is a degraded keyword fallback.
+        Degraded rankings are not cached.
+
+    Raises:
+        OverloadedError: If a Gemini ranking is needed but cannot be admitted.
+    """
+    key = _query_key(query)
+    if key in kb.rankings:
+        kb.rankings.move_to_end(key)
+        return kb.rankings[key], False
+
+    if gemini_client:
+        async with admission.slot(client_id):
+            scores = await _semantic_scores(kb, query)
+        if scores is None:
+            return _keyword_scores(kb, query), True
+    else:
+        scores = _keyword_scores(kb, query)
+
+    _lru_put(kb, kb.rankings, key, scores)
+    return scores, False
+
+
+def _fingerprint(*parts) -> str:
+    """Short stable hash used to bind cursors to a query and ranking."""
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()[:8]
+
+
+def _make_cursor(offset: int, query_fp: str, ranking_fp: str) -> str:
+    """Encode a cursor as "<offset>.<query fingerprint><ranking fingerprint>"."""
+    return f"{offset}.{query_fp}{ranking_fp}"
+
+
+def _parse_cursor(cursor: str) -> Tuple[int, str, str]:
+    """Split a cursor into (offset, query fingerprint, ranking fingerprint).
+
+    Raises:
+        ValueError: If the cursor is malformed.
+    """
+    offset_text, _, fingerprints = cursor.partition(".")
+    offset = int(offset_text)
+    if offset < 0 or len(fingerprints) != 16:
+        raise ValueError(cursor)
+    return offset, fingerprints[:8], fingerprints[8:]
+
+
+async def _structured_search(kb: KnowledgeBase, query: str, top_k: int, cursor: Optional[str], ids_only: bool, client_id: str) -> Tuple[str, bool]:
+    """Return one page of ranked results as compact JSON, and whether it is degraded.
+
+    Cursors are bound to the tenant, the normalized query and the ranking they
+    were issued for. A cursor used with another query, or after the ranking was
+    recomputed differently (e.g. after cache eviction), is rejected rather than
+    returning pages that repeat or skip entries.
+    """
+    query_fp = _fingerprint(kb.name, _query_key(query))
+    offset = 0
+    ranking_fp = None
+    if cursor:
+        try:
+            offset, cursor_query_fp, ranking_fp = _parse_cursor(cursor)
+        except ValueError:
+            return json.dumps({"error": f"Invalid cursor: {cursor}"}), False
+        if cursor_query_fp != query_fp:
+            return json.dumps({"error": "Cursor does not belong to this query or knowledge base"}), False
+    top_k = max(1, min(int(top_k), MAX_TOP_K))
+
+    try:
+        scores, degraded = await _rank(kb, query, client_id)
+    except OverloadedError as e:
+        logger.warning(f"Ranking not admitted: {e}")
+        if OVERLOAD_MODE == 'reject':
+            return json.dumps({"error": OVERLOADED_MESSAGE, "retry": True}), False
+        scores = _keyword_scores(kb, query)
+        degraded = True
+
+    current_ranking_fp = _fingerprint([entry_id for entry_id, _ in scores])
+    if ranking_fp is not None and ranking_fp != current_ranking_fp:
+        return json.dumps({"error": "Cursor has expired; request the first page again", "retry": True}), False
+
+    page = scores[offset:offset + top_k]
+
+    results = []
+    for entry_id, score in page:
+        item = {"id": entry_id, "score": score}
+        if not ids_only:
+            qa = kb.qa_pairs[entry_id - 1]
+            item["question"] = qa.get('question', '')
+            item["answer"] = qa.get('answer', '')
+        results.append(item)
+
+    next_offset = offset + len(page)
+    payload = {
+        "total": len(scores),
+        "results": results,
+        "next_cursor": _make_cursor(next_offset, query_fp, current_ranking_fp) if next_offset < len(scores) else None,
+    }
+    if degraded:
+        payload["degraded"] = True
+    return json.dumps(payload, separators=(",", ":")), degraded
+
+
+@mcp.resource("usage://gemini")
+def get_gemini_usage() -> str:
+    """Gemini token usage totals per tool since the server started."""
+    return json.dumps(usage_tracker.snapshot())
+
+
 # Run the server
 if __name__ == "__main__":
     logger.info("Starting MCP server with stdio transport...")
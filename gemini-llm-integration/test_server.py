@@ -0,0 +1,44 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("mcp")
+pytest.importorskip("google.genai")
+
+import server
+
+
+def test_cancelled_waiter_releases_client_slot():
+    async def scenario():
+        admission = server.AdmissionController(
+            max_concurrent=1, max_queued=4, per_client_limit=2, queue_timeout=5
+        )
+        holder_entered = asyncio.Event()
+        release_holder = asyncio.Event()
+
+        async def holder():
+            async with admission.slot("a"):
+                holder_entered.set()
+                await release_holder.wait()
+
+        async def waiter():
+            async with admission.slot("b"):
+                pass
+
+        holder_task = asyncio.create_task(holder())
+        await holder_entered.wait()
+
+        waiter_task = asyncio.create_task(waiter())
+        await asyncio.sleep(0)
+        waiter_task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter_task
+
+        assert "b" not in admission._per_client
+        assert admission._waiting == 0
+
+        release_holder.set()
+        await holder_task
+        assert admission._per_client == {}
+
+    asyncio.run(scenario())